@@ -0,0 +1,24 @@
+"""Compiles the batch kernels of grand._kernels ahead of time (AOT) with numba.pycc, into the extension module
+grand._kernels_aot, so that they can be used without compiling them at the first call (and without numba at runtime).
+The extension is built by setup.py when numba is installed, or by running: python -m grand._compile_kernels
+"""
+
+__author__ = "Mohamed-Rafik Bouguelia"
+__license__ = "MIT"
+__email__ = "mohamed-rafik.bouguelia@hh.se"
+
+from numba.pycc import CC
+from grand import _kernels
+import os
+
+cc = CC("_kernels_aot")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The samples X are float32 (see grand.group_anomaly.PeerGrouping), the distances D and the medians are float64
+cc.export("median_batch", "UniTuple(f8[:], 2)(f4[:,:], i8[:], i8[:], f8[:,:])")(_kernels.median_batch.py_func)
+cc.export("knn_batch", "Tuple((f8[:], f8[:], f8[:,:]))(f4[:,:], f8[:,:], i8[:], i8[:], i8)")(_kernels.knn_batch.py_func)
+cc.export("lof_batch", "UniTuple(f8[:], 2)(f8[:,:], i8[:], i8[:], i8)")(_kernels.lof_batch.py_func)
+
+
+if __name__ == "__main__":
+    cc.compile()
@@ -0,0 +1,243 @@
+"""Compiled kernels for the non-conformity measures.
+The kernels are compiled with numba when it is installed. Otherwise NUMBA_AVAILABLE is False
+and the strangeness measures (see grand.conformal) use their NumPy implementation instead.
+"""
+
+__author__ = "Mohamed-Rafik Bouguelia"
+__license__ = "MIT"
+__email__ = "mohamed-rafik.bouguelia@hh.se"
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# ===========================================
+@njit(cache=True)
+def _distance(x, y):
+    s = 0.
+    for j in range(x.shape[0]):
+        d = x[j] - y[j]
+        s += d * d
+    return np.sqrt(s)
+
+
+@njit(cache=True, parallel=True)
+def median_strangeness(X, med):
+    '''Distance of each row of X to the median med'''
+    scores = np.empty(X.shape[0])
+    for i in prange(X.shape[0]):
+        scores[i] = _distance(X[i], med)
+    return scores
+
+
+# ===========================================
+@njit(cache=True)
+def _k_smallest(dists, k):
+    # Indexes of the k smallest values of dists, by increasing value. They are selected by insertion into
+    # a sorted buffer of size k, which takes O(n) when k is small compared to n (instead of sorting dists)
+    k = min(k, dists.shape[0])
+    ids = np.empty(k, dtype=np.int64)
+    m = 0
+    for i in range(dists.shape[0]):
+        v = dists[i]
+        if m < k:
+            j = m
+            m += 1
+        elif v < dists[ids[k - 1]]:
+            j = k - 1
+        else:
+            continue
+        while j > 0 and dists[ids[j - 1]] > v:
+            ids[j] = ids[j - 1]
+            j -= 1
+        ids[j] = i
+    return ids
+
+
+@njit(cache=True)
+def _knn_mean(dists, k):
+    # Average of the k smallest distances of a reference sample to the reference samples (itself included, at distance 0)
+    kk = min(k, dists.shape[0] - 1)
+    if kk <= 0:
+        return np.nan
+    nearest = dists[_k_smallest(dists, kk + 1)]
+    return nearest[1:].mean() # the nearest one (at distance 0) is the sample itself
+
+
+@njit(cache=True, parallel=True)
+def knn_scores(D, k):
+    '''Average distance of each sample to its k nearest neighbours among the other samples,
+    where D holds the distances between some of the samples (rows) and all the samples (columns)
+    '''
+    scores = np.empty(D.shape[0])
+    for a in prange(D.shape[0]):
+        scores[a] = _knn_mean(D[a], k)
+    return scores
+
+
+@njit(cache=True)
+def knn_strangeness(dists, k):
+    '''Average distance of a test sample to its k nearest neighbours, and the indexes of these neighbours,
+    where dists are the distances between the test sample and the reference samples.
+    If the test sample is equal to one of the reference samples, this one is not considered as a neighbour.
+    '''
+    ids = _k_smallest(dists, k + 1)
+    if len(ids) > 0 and dists[ids[0]] == 0:
+        ids = ids[1:k + 1]
+    else:
+        ids = ids[:k]
+    if len(ids) == 0:
+        return np.nan, ids
+    return dists[ids].mean(), ids
+
+
+# ===========================================
+@njit(cache=True)
+def lof_fit(D, ids, k):
+    '''Fits the local outlier factor (LOF) with k neighbours (same definitions as sklearn's LocalOutlierFactor),
+    where the samples are the rows ids of D, the matrix of pairwise distances (ids may contain duplicates).
+
+    Returns:
+    --------
+    scores : array, shape (n_samples,)
+        LOF of each sample with respect to the other samples
+
+    lrd : array, shape (n_samples,)
+        Local reachability density of each sample
+
+    k_dists : array, shape (n_samples,)
+        Distance of each sample to its k'th nearest neighbour
+    '''
+    n = ids.shape[0]
+    kk = max(1, min(k, n - 1))
+
+    neighbors = np.empty((n, kk), dtype=np.int64)
+    k_dists = np.empty(n)
+    for a in range(n):
+        dists = D[ids[a]][ids]
+        dists[a] = np.inf # the sample itself is not its own neighbour
+        nbrs = _k_smallest(dists, kk)
+        neighbors[a] = nbrs
+        k_dists[a] = dists[nbrs[kk - 1]]
+
+    lrd = np.empty(n)
+    for a in range(n):
+        reach = np.maximum(D[ids[a]][ids[neighbors[a]]], k_dists[neighbors[a]])
+        lrd[a] = 1. / (reach.mean() + 1e-10)
+
+    scores = np.empty(n)
+    for a in range(n):
+        scores[a] = (lrd[neighbors[a]] / lrd[a]).mean()
+
+    return scores, lrd, k_dists
+
+
+@njit(cache=True)
+def lof_strangeness(dists, k, lrd, k_dists):
+    '''Local outlier factor of a test sample, where dists are the distances between the test sample
+    and the reference samples, and lrd and k_dists are returned by lof_fit
+    '''
+    kk = max(1, min(k, dists.shape[0] - 1))
+    ids = _k_smallest(dists, kk)
+
+    reach = np.maximum(dists[ids], k_dists[ids])
+    x_lrd = 1. / (reach.mean() + 1e-10)
+    return (lrd[ids] / x_lrd).mean()
+
+
+# ===========================================
+@njit(cache=True)
+def _pvalue(scores, score):
+    return np.count_nonzero(scores > score) / scores.shape[0]
+
+
+@njit(cache=True)
+def _reference_ids(owners, i, min_size):
+    # Rows of the samples which do not belong to the owner of the sample i, i.e. its reference group.
+    # The last one is repeated to have at least min_size samples (as in grand.conformal.StrangenessLOF)
+    ids = np.flatnonzero(owners != owners[i])
+    if 0 < ids.shape[0] < min_size:
+        padded = np.full(min_size, ids[-1])
+        padded[:ids.shape[0]] = ids
+        return padded
+    return ids
+
+
+@njit(cache=True, parallel=True)
+def median_batch(X, owners, ids_test, meds):
+    '''Strangeness and p-value of each test sample X[ids_test[t]] with respect to its reference group
+    (the samples of the other units), using the distance to the median meds[t] of the reference group
+    '''
+    S = np.empty(ids_test.shape[0])
+    P = np.empty(ids_test.shape[0])
+    for t in prange(ids_test.shape[0]):
+        ids = _reference_ids(owners, ids_test[t], 0)
+        scores = np.empty(ids.shape[0])
+        for a in range(ids.shape[0]):
+            scores[a] = _distance(X[ids[a]], meds[t])
+        S[t] = _distance(X[ids_test[t]], meds[t])
+        P[t] = _pvalue(scores, S[t])
+    return S, P
+
+
+@njit(cache=True, parallel=True)
+def knn_batch(X, D, owners, ids_test, k):
+    '''Strangeness, p-value and representative (mean of the k nearest neighbours) of each test sample
+    X[ids_test[t]] with respect to its reference group (the samples of the other units),
+    where D is the matrix of pairwise distances between the rows of X
+    '''
+    S = np.empty(ids_test.shape[0])
+    P = np.empty(ids_test.shape[0])
+    R = np.empty((ids_test.shape[0], X.shape[1]))
+    for t in prange(ids_test.shape[0]):
+        ids = _reference_ids(owners, ids_test[t], 0)
+        scores = np.empty(ids.shape[0])
+        dists = np.empty(ids.shape[0])
+        for a in range(ids.shape[0]):
+            for b in range(ids.shape[0]):
+                dists[b] = D[ids[a], ids[b]]
+            scores[a] = _knn_mean(dists, k)
+        s, nbrs = knn_strangeness(D[ids_test[t]][ids], k)
+        S[t] = s
+        P[t] = _pvalue(scores, s)
+        for j in range(X.shape[1]):
+            r = 0.
+            for b in nbrs:
+                r += X[ids[b], j]
+            R[t, j] = r / nbrs.shape[0] if nbrs.shape[0] > 0 else np.nan
+    return S, P, R
+
+
+@njit(cache=True, parallel=True)
+def lof_batch(D, owners, ids_test, k):
+    '''Strangeness (local outlier factor) and p-value of each test sample ids_test[t] with respect to
+    its reference group (the samples of the other units), where D is the matrix of pairwise distances
+    '''
+    S = np.empty(ids_test.shape[0])
+    P = np.empty(ids_test.shape[0])
+    for t in prange(ids_test.shape[0]):
+        ids = _reference_ids(owners, ids_test[t], k)
+        scores, lrd, k_dists = lof_fit(D, ids, k)
+        S[t] = lof_strangeness(D[ids_test[t]][ids], k, lrd, k_dists)
+        P[t] = _pvalue(scores, S[t])
+    return S, P
+
+
+# ===========================================
+# The batch kernels compiled ahead of time (see grand._compile_kernels), when the extension was built with the package.
+# They are used instead of the ones above (see grand.group_anomaly.GroupAnomaly), since they do not need to be compiled
+# at the first call, and do not need numba at runtime. Unlike the ones above, they do not run in parallel.
+try:
+    from grand import _kernels_aot
+    AOT_AVAILABLE = True
+except ImportError:
+    _kernels_aot = None
+    AOT_AVAILABLE = False
@@ -7,8 +7,9 @@ __author__ = "Mohamed-Rafik Bouguelia"
 __license__ = "MIT"
 __email__ = "mohamed-rafik.bouguelia@hh.se"
 
-from grand import utils
+from grand import utils, _kernels
 from sklearn.neighbors import LocalOutlierFactor
+from scipy.spatial.distance import cdist
 import numpy as np
 
 
@@ -32,11 +33,11 @@ class Strangeness:
     def is_fitted(self):
         return self.X is not None
 
-    def fit(self, X):
+    def fit(self, X, D=None, med=None):
         utils.validate_fit_input(X)
         self.X = X
 
-    def predict(self, x):
+    def predict(self, x, dists=None):
         utils.validate_is_fitted(self.is_fitted())
         utils.validate_get_input(x)
 
@@ -47,64 +48,118 @@ class Strangeness:
 
 
 class StrangenessMedian(Strangeness):
-    '''Strangeness based on the distance to the median data (or most central pattern)'''
+    '''Strangeness based on the distance to the median data (or most central pattern).
+    The median med of X given to fit is computed when it is not provided.
+    '''
 
     def __init__(self):
         super().__init__()
 
-    def fit(self, X):
+    def fit(self, X, D=None, med=None):
         super().fit(X)
-        self.med = np.median(X, axis=0)
-        self.scores = [self.predict(x)[0] for x in self.X]
+        self.med = np.median(X, axis=0) if med is None else med
+        if _kernels.NUMBA_AVAILABLE:
+            self.scores = _kernels.median_strangeness(np.asarray(X, dtype=float), self.med)
+        else:
+            self.scores = [self.predict(x)[0] for x in self.X]
 
-    def predict(self, x):
+    def predict(self, x, dists=None):
         super().predict(x)
         diff = x - self.med
-        dist = np.linalg.norm(diff)
+        if _kernels.NUMBA_AVAILABLE:
+            dist = _kernels.median_strangeness(np.asarray([x], dtype=float), self.med)[0]
+        else:
+            dist = np.linalg.norm(diff)
         return dist, diff, self.med
 
 
 class StrangenessKNN(Strangeness):
-    '''Strangeness based on the average distance to the k nearest neighbors'''
+    '''Strangeness based on the average distance to the k nearest neighbors.
+    The pairwise distances D (between the rows of X) given to fit, and the distances dists (between x and
+    the rows of X) given to predict, are computed when they are not provided.
+    When D is not given, it is computed by blocks of BLOCK_SIZE rows, so that the whole matrix is never stored.
+    '''
 
     def __init__(self, k=10):
         super().__init__()
         self.k = k
+        self.BLOCK_SIZE = 64
 
-    def fit(self, X):
+    def fit(self, X, D=None, med=None):
         super().fit(X)
-        self.scores = [self.predict(xx)[0] for xx in self.X]
-
-    def predict(self, x):
+        self.X = np.asarray(X, dtype=float)
+        if D is not None:
+            self.scores = self._knn_scores(D)
+        else:
+            self.scores = np.empty(len(self.X))
+            for i in range(0, len(self.X), self.BLOCK_SIZE):
+                self.scores[i: i + self.BLOCK_SIZE] = self._knn_scores(cdist(self.X[i: i + self.BLOCK_SIZE], self.X))
+
+    def _knn_scores(self, D):
+        # Scores of the samples of the rows of D, which holds their distances to all the rows of X
+        if _kernels.NUMBA_AVAILABLE:
+            return _kernels.knn_scores(D, self.k)
+        kk = min(self.k, D.shape[1] - 1)
+        nearest = np.sort(np.partition(D, kk, axis=1)[:, :kk+1], axis=1) # only the kk+1 nearest ones are sorted
+        return nearest[:, 1:].mean(axis=1) # the nearest one (at distance 0) is the sample itself
+
+    def predict(self, x, dists=None):
         super().predict(x)
-        dists = np.array([np.linalg.norm(x - xx) for xx in self.X])
-        ids = np.argsort(dists)
-        ids = ids[1:self.k+1] if np.array_equal(x, self.X[ids[0]]) else ids[:self.k]
+        if dists is None: dists = cdist([x], self.X)[0]
+
+        if _kernels.NUMBA_AVAILABLE:
+            mean_knn_dists, ids = _kernels.knn_strangeness(dists, self.k)
+        else:
+            ids = np.argpartition(dists, min(self.k, len(dists) - 1))[:self.k+1] # the k+1 nearest ones, then sorted
+            ids = ids[np.argsort(dists[ids])]
+            ids = ids[1:self.k+1] if dists[ids[0]] == 0 else ids[:self.k]
+            mean_knn_dists = np.mean(dists[ids])
 
-        mean_knn_dists = np.mean(dists[ids])
-        representative = np.mean(np.array(self.X)[ids], axis=0)
+        representative = np.mean(self.X[ids], axis=0)
         diff = x - representative
         return mean_knn_dists, diff, representative
 
 
 class StrangenessLOF(Strangeness):
-    '''Strangeness based on the local outlier factor (LOF)'''
+    '''Strangeness based on the local outlier factor (LOF).
+    When the pairwise distances D (between the rows of X) are given to fit, the LOF is computed from them
+    (and from the distances dists between x and the rows of X given to predict, computed if not provided).
+    Otherwise, sklearn's LocalOutlierFactor finds the (euclidean) neighbours itself, without building D.
+    '''
 
     def __init__(self, k=10):
         super().__init__()
         utils.validate_int_higher(k, 0)
         self.k = k
         self.lof = LocalOutlierFactor(n_neighbors=k, novelty=True, contamination="auto")
+        self.lof_precomputed = LocalOutlierFactor(n_neighbors=k, novelty=True, contamination="auto", metric="precomputed")
 
-    def fit(self, X):
+    def fit(self, X, D=None, med=None):
         super().fit(X)
-        X_ = list(X) + [ X[-1] for _ in range(self.k - len(X)) ]
-        self.lof.fit(X_)
-        self.scores = -1 * self.lof.negative_outlier_factor_
-
-    def predict(self, x):
+        self.med = np.median(X, axis=0) if med is None else med # FIXME: temporary hack (used as the representative)
+
+        # Repeats the last sample if there are less than k samples
+        self.ids = np.r_[np.arange(len(X)), np.full(max(self.k - len(X), 0), len(X) - 1)]
+        self.precomputed = D is not None
+        if not self.precomputed:
+            self.lof.fit(np.asarray(X)[self.ids])
+            self.scores = -1 * self.lof.negative_outlier_factor_
+        elif _kernels.NUMBA_AVAILABLE:
+            self.scores, self.lrd, self.k_dists = _kernels.lof_fit(D, self.ids, self.k)
+        else:
+            self.lof_precomputed.fit(D[np.ix_(self.ids, self.ids)])
+            self.scores = -1 * self.lof_precomputed.negative_outlier_factor_
+
+    def predict(self, x, dists=None):
         super().predict(x)
-        outlier_score = -1 * self.lof.score_samples([x])[0]
-        med = np.median(self.X, axis=0) # FIXME: temporary hack
-        diff = x - med
-        return outlier_score, diff, med
+        if not self.precomputed:
+            outlier_score = -1 * self.lof.score_samples([x])[0]
+        else:
+            if dists is None: dists = cdist([x], self.X)[0]
+            dists_ = dists[self.ids]
+            if _kernels.NUMBA_AVAILABLE:
+                outlier_score = _kernels.lof_strangeness(dists_, self.k, self.lrd, self.k_dists)
+            else:
+                outlier_score = -1 * self.lof_precomputed.score_samples([dists_])[0]
+        diff = x - self.med
+        return outlier_score, diff, self.med
@@ -0,0 +1,101 @@
+"""Provides statistics which are maintained incrementally over a sliding window of samples.
+"""
+
+__author__ = "Mohamed-Rafik Bouguelia"
+__license__ = "MIT"
+__email__ = "mohamed-rafik.bouguelia@hh.se"
+
+from grand._kernels import njit
+import numpy as np
+
+
+class OnlineMedian:
+    '''Median of each column (feature) of a multiset of samples, maintained as samples are pushed and removed.
+    Each column is kept sorted, so that pushing or removing a sample takes a binary search and a shift per column,
+    and the median (possibly excluding the samples of another OnlineMedian) is found by binary search.
+    The operations are compiled with numba (see grand._kernels.NUMBA_AVAILABLE).
+
+    Parameters:
+    -----------
+    nb_features : int
+        Number of features (columns) of the samples
+    '''
+
+    def __init__(self, nb_features):
+        self.S = np.empty((nb_features, 64), dtype=np.float32)
+        self.n = 0
+
+    # ===========================================
+    def push(self, x):
+        '''Adds the sample x, shape (n_features,)'''
+
+        if self.n == self.S.shape[1]:
+            self.S = np.concatenate([self.S, np.empty_like(self.S)], axis=1)
+        _insert(self.S, self.n, np.asarray(x, dtype=np.float32))
+        self.n += 1
+
+    # ===========================================
+    def remove(self, x):
+        '''Removes the sample x, shape (n_features,), which should have been pushed before'''
+
+        _remove(self.S, self.n, np.asarray(x, dtype=np.float32))
+        self.n -= 1
+
+    # ===========================================
+    def median(self, exclude=None):
+        '''Returns the median of each column, shape (n_features,).
+
+        Parameters:
+        -----------
+        exclude : OnlineMedian, optional
+            If given, the samples in exclude (which should be a subset of the samples in self) are not considered.
+        '''
+
+        if exclude is None or exclude.n == 0:
+            return _median_excluding(self.S, self.n, self.S[:, :0], 0)
+        return _median_excluding(self.S, self.n, exclude.S, exclude.n)
+
+
+# ===========================================
+@njit(cache=True)
+def _insert(S, n, x):
+    for j in range(S.shape[0]):
+        i = np.searchsorted(S[j, :n], x[j])
+        for t in range(n, i, -1):
+            S[j, t] = S[j, t - 1]
+        S[j, i] = x[j]
+
+
+@njit(cache=True)
+def _remove(S, n, x):
+    for j in range(S.shape[0]):
+        i = np.searchsorted(S[j, :n], x[j])
+        for t in range(i, n - 1):
+            S[j, t] = S[j, t + 1]
+
+
+@njit(cache=True)
+def _kth_excluding(a, na, b, nb, k):
+    # k'th smallest value (from 0) of the multiset difference a[:na] - b[:nb], where both are sorted.
+    # The number of values of the difference that are <= a[i] is non-decreasing with i.
+    lo, hi = 0, na - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        rank = np.searchsorted(a[:na], a[mid], side="right") - np.searchsorted(b[:nb], a[mid], side="right")
+        if rank >= k + 1:
+            hi = mid
+        else:
+            lo = mid + 1
+    return a[lo]
+
+
+@njit(cache=True)
+def _median_excluding(A, na, B, nb):
+    m = na - nb
+    med = np.empty(A.shape[0])
+    for j in range(A.shape[0]):
+        if m % 2 == 1:
+            med[j] = _kth_excluding(A[j], na, B[j], nb, m // 2)
+        else:
+            med[j] = (np.float64(_kth_excluding(A[j], na, B[j], nb, m // 2 - 1)) + _kth_excluding(A[j], na, B[j], nb, m // 2)) / 2
+    return med
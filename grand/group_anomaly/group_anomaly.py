@@ -8,10 +8,10 @@ __license__ = "MIT"
 __email__ = "mohamed-rafik.bouguelia@hh.se"
 
 from .peer_grouping import PeerGrouping
-from .transformer import Transformer
+from .transformer import TransformerBatch
 from grand import IndividualAnomalyInductive
-from grand.utils import DeviationContext, append_to_df, TestUnitError, NoRefGroupError
-from grand import utils
+from grand.utils import DeviationContext, TestUnitError, NoRefGroupError
+from grand import utils, _kernels
 import pandas as pd, matplotlib.pylab as plt, numpy as np
 from pandas.plotting import register_matplotlib_converters
 
@@ -42,10 +42,19 @@ class GroupAnomaly:
         
     dev_threshold : float
         Threshold in [0,1] on the deviation level
+        
+    keep_history : bool
+        If True, the data of all units and the strangeness, p-values and deviation levels of the target units are kept
+        for plotting and analysis (plot_deviations, plot_explanations, get_similar_deviations, dfs and dfs_original).
+        If False, only the data within the reference group window (w_ref_group) and the state needed to compute
+        the deviation levels are kept, so that the memory is bounded. It is recommended for deployment.
     '''
 
+    _DEFAULT_DEV = DeviationContext(0, 0.5, 0, False) # no deviation by default (shared, as DeviationContext is immutable)
+    _MIN_TARGETS_TRACK_MEDIAN = 3 # with fewer target units, one np.median per target is cheaper than maintaining the median incrementally
+
     def __init__(self, nb_units, ids_target_units, w_ref_group="7days", w_martingale=15, non_conformity="median", k=20,
-                 dev_threshold=.6, transformer=None, w_transform=30, columns=None):
+                 dev_threshold=.6, transformer=None, w_transform=30, columns=None, keep_history=True):
         self.nb_units = nb_units
         self.ids_target_units = ids_target_units
         self.w_ref_group = w_ref_group
@@ -56,12 +65,20 @@ class GroupAnomaly:
         self.transformer = transformer
         self.w_transform = w_transform
         self.columns = columns
+        self.keep_history = keep_history
 
-        self.dfs_original = [ pd.DataFrame( data = [], index = [] ) for _ in range(nb_units) ]
-        self.dfs = [ pd.DataFrame( data = [], index = [] ) for _ in range(nb_units) ] # FIXME: duplicates with self.detectors[i].df
-        self.pg = PeerGrouping(self.w_ref_group)
-        self.detectors = [ IndividualAnomalyInductive(w_martingale, non_conformity, k, dev_threshold) for _ in range(nb_units) ]
-        self.transformers = [Transformer(w_transform, transformer) for _ in range(nb_units)]
+        # Per-unit history stored in preallocated arrays (grown by doubling), instead of DataFrames
+        # which would be copied at each time step. The original and transformed data share the same times.
+        self._vals_original = [None] * nb_units
+        self._vals = [None] * nb_units # FIXME: duplicates with self.detectors[i].df
+        self._times = [None] * nb_units
+        self._len = [0] * nb_units
+        self._w_ref_group = pd.to_timedelta(w_ref_group).to_timedelta64() # parsed once
+        self._needs_distances = non_conformity in ["knn", "lof"]
+        track_median = non_conformity == "median" and len(ids_target_units) >= self._MIN_TARGETS_TRACK_MEDIAN
+        self.pg = PeerGrouping(self._w_ref_group, nb_units, track_median=track_median)
+        self.detectors = [ IndividualAnomalyInductive(w_martingale, non_conformity, k, dev_threshold, keep_history=keep_history) for _ in range(nb_units) ]
+        self.tbatch = TransformerBatch(nb_units, w_transform, transformer)
         
     # ===========================================
     # TODO assert len(x_units) == nb_units, or include the name of units with the data ...
@@ -93,27 +110,111 @@ class GroupAnomaly:
             True if the deviation is above the threshold (dev_threshold)
         '''
 
-        self.dfs_original = [append_to_df(self.dfs_original[i], dt, x) for i, x in enumerate(x_units)]
+        x_units_tr = self.tbatch.transform_batch(x_units)
 
-        x_units_tr = [transformer.transform(x) for x, transformer in zip(x_units, self.transformers)]
-        self.dfs = [append_to_df(self.dfs[i], dt, x) for i, x in enumerate(x_units_tr)]
+        dt64 = pd.Timestamp(dt).to_datetime64()
+        if self.keep_history:
+            for uid, (x, x_tr) in enumerate(zip(x_units, x_units_tr)):
+                if len(x) > 0: self._append(uid, dt64, x, x_tr)
+        self.pg.update(dt64, x_units_tr)
 
-        deviations = []
+        # The distances between all samples of the group are computed once, and shared by the target units
+        X, owners = self.pg.get_group()
+        D = self.pg.get_distances() if self._needs_distances else None
+
+        if _kernels.AOT_AVAILABLE or _kernels.NUMBA_AVAILABLE:
+            return self._predict_batch(dt, dt64, X, owners, D)
+
+        deviations = [self._DEFAULT_DEV] * len(self.ids_target_units)
         
-        for uid in self.ids_target_units:
+        for pos, uid in enumerate(self.ids_target_units):
             detector = self.detectors[uid]
             
             try:
-                x, Xref = self.pg.get_target_and_reference(uid, dt, self.dfs)
-                detector.fit(Xref)
-                devContext = detector.predict(dt, x)
+                id_test, ids_ref = self.pg.get_target_and_reference_ids(uid, dt64)
+                D_ref, dists = (None, None) if D is None else (D[np.ix_(ids_ref, ids_ref)], D[id_test, ids_ref])
+                detector.fit(X[ids_ref], D_ref, self.pg.get_reference_median(uid))
+                deviations[pos] = detector.predict(dt, X[id_test], dists)
             except (TestUnitError, NoRefGroupError):
-                devContext = DeviationContext(0, 0.5, 0, False) # no deviation by default
-            
-            deviations.append(devContext)
+                pass
             
         return deviations
         
+    # ===========================================
+    def _predict_batch(self, dt, dt64, X, owners, D):
+        '''Private method for internal use only.
+        Computes the strangeness, p-value and representative of all the target units in one compiled call
+        (see grand._kernels), without copying their reference groups, then updates the deviation level of their detectors.
+        The kernels compiled ahead of time are used if they were built, otherwise the ones compiled with numba.
+        '''
+
+        positions, targets, ids_test = [], [], []
+        for pos, uid in enumerate(self.ids_target_units):
+            try:
+                ids_test.append(self.pg.get_target_id(uid, dt64))
+                positions.append(pos)
+                targets.append(uid)
+            except (TestUnitError, NoRefGroupError):
+                pass
+        ids_test = np.array(ids_test, dtype=np.int64)
+        kernels = _kernels._kernels_aot if _kernels.AOT_AVAILABLE else _kernels
+
+        if self.non_conformity == "knn":
+            S, P, R = kernels.knn_batch(X, D, owners, ids_test, self.k)
+        else:
+            R = np.empty((len(targets), X.shape[1]))
+            for t, uid in enumerate(targets):
+                med = self.pg.get_reference_median(uid)
+                R[t] = np.median(X[owners != uid].astype(float), axis=0) if med is None else med # averaged in float64, as in OnlineMedian
+            if self.non_conformity == "median":
+                S, P = kernels.median_batch(X, owners, ids_test, R)
+            else:
+                S, P = kernels.lof_batch(D, owners, ids_test, self.k)
+
+        deviations = [self._DEFAULT_DEV] * len(self.ids_target_units)
+        for t, (pos, uid) in enumerate(zip(positions, targets)):
+            deviations[pos] = self.detectors[uid].update(dt, X[ids_test[t]], S[t], P[t], R[t])
+        return deviations
+
+    # ===========================================
+    def _append(self, uid, dt64, x, x_tr):
+        '''Private method for internal use only.
+        Appends the original and transformed samples of a unit at time dt64 to its history (amortized O(1)).
+        '''
+
+        i = self._len[uid]
+        self._vals_original[uid], self._times[uid], _ = utils.fast_append(self._vals_original[uid], self._times[uid], i, dt64, x, np.float32)
+        self._vals[uid], self._times[uid], self._len[uid] = utils.fast_append(self._vals[uid], self._times[uid], i, dt64, x_tr, np.float32)
+
+    # ===========================================
+    def _to_df(self, uid, original=False):
+        '''Private method for internal use only.
+        Builds a DataFrame view of the history of a unit (only needed for plotting).
+        '''
+
+        utils.validate_history_kept(self.keep_history)
+        vals, n = (self._vals_original if original else self._vals)[uid], self._len[uid]
+        if n == 0: return pd.DataFrame(data=[], index=[])
+        return pd.DataFrame(data=vals[:n], index=pd.DatetimeIndex(self._times[uid][:n]))
+
+    def _sub_history(self, uid, from_time, to_time, original=False):
+        '''Private method for internal use only.
+        Returns the times and values of the history of a unit between from_time and to_time (both included).
+        '''
+
+        vals, n = (self._vals_original if original else self._vals)[uid], self._len[uid]
+        if n == 0: return np.empty(0, dtype="datetime64[ns]"), np.empty((0, 0))
+        times, i0, i1 = utils.time_range(self._times[uid][:n], from_time, to_time)
+        return times[i0:i1], vals[i0:i1]
+
+    @property
+    def dfs_original(self):
+        return [self._to_df(uid, original=True) for uid in range(self.nb_units)]
+
+    @property
+    def dfs(self):
+        return [self._to_df(uid) for uid in range(self.nb_units)]
+
     # ===========================================
     def get_similar_deviations(self, uid, from_time, to_time, k_devs=2, min_len=5, dev_threshold=None):
         target_devsig = self.detectors[uid].get_deviation_signature(from_time, to_time)
@@ -133,19 +234,20 @@ class GroupAnomaly:
     def plot_deviations(self, figsize=None, savefig=None, plots=["data", "transformed_data", "strangeness", "deviation", "threshold"], debug=False):
         '''Plots the anomaly score, deviation level and p-value, over time.'''
 
+        utils.validate_history_kept(self.keep_history)
         register_matplotlib_converters()
 
-        if self.transformer is None and "transformed_data" in plots:
-            plots.remove("transformed_data")
-
-        plots, nb_axs, i = list(set(plots)), 0, 0
+        plots, nb_axs, i = frozenset(plots), 0, 0
+        if self.transformer is None:
+            plots -= {"transformed_data"} # without modifying the given list (or the default one)
+        has_deviation_panel = bool(plots & {"pvalue", "deviation", "threshold"})
         if "data" in plots:
             nb_axs += 1
         if "transformed_data" in plots:
             nb_axs += 1
         if "strangeness" in plots:
             nb_axs += 1
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             nb_axs += 1
 
         fig, axs = plt.subplots(nb_axs, sharex="row", figsize=figsize)
@@ -156,7 +258,7 @@ class GroupAnomaly:
             axs[i].set_xlabel("Time")
             axs[i].set_ylabel("Feature 0")
             for uid in self.ids_target_units:
-                df = self.dfs_original[uid]
+                df = self._to_df(uid, original=True)
                 axs[i].plot(df.index, df.values[:, 0], label="Unit {}".format(uid))
             axs[i].legend()
             i += 1
@@ -165,7 +267,7 @@ class GroupAnomaly:
             axs[i].set_xlabel("Time")
             axs[i].set_ylabel("Trans. Feature 0")
             for uid in self.ids_target_units:
-                df = self.dfs[uid]
+                df = self._to_df(uid)
                 axs[i].plot(df.index, df.values[:, 0], label="Unit {}".format(uid))
                 if debug and uid == self.ids_target_units[-1]:
                     T, representatives = self.detectors[uid].T, self.detectors[uid].representatives
@@ -183,7 +285,7 @@ class GroupAnomaly:
             axs[i].legend()
             i += 1
 
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             axs[i].set_xlabel("Time")
             axs[i].set_ylabel("Deviation")
             axs[i].set_ylim(0, 1)
@@ -205,21 +307,25 @@ class GroupAnomaly:
     # ===========================================
     def plot_explanations(self, uid, from_time, to_time, figsize=None, savefig=None, k_features=4):
         # TODO: validate if the period (from_time, to_time) has data before plotting
+        utils.validate_history_kept(self.keep_history)
         detector = self.detectors[uid]
-        sub_dfs_ori = [self.dfs_original[uuid][from_time: to_time] for uuid in range(self.nb_units)]
-        sub_dfs = [self.dfs[uuid][from_time: to_time] for uuid in range(self.nb_units)]
-        sub_representatives_df = pd.DataFrame(index=detector.T, data=detector.representatives)[from_time: to_time]
-        sub_diffs_df = pd.DataFrame(index=detector.T, data=detector.diffs)[from_time: to_time]
+        sub_ori = [self._sub_history(u, from_time, to_time, original=True) for u in range(self.nb_units)]
+        sub = [self._sub_history(u, from_time, to_time) for u in range(self.nb_units)]
+        T, i0, i1 = utils.time_range(detector.T, from_time, to_time)
+        sub_times = T[i0:i1]
+        sub_representatives = np.asarray(detector.representatives)[i0:i1]
+        sub_diffs = np.asarray(detector.diffs)[i0:i1]
 
-        nb_features = sub_diffs_df.values.shape[1]
+        nb_features = sub_diffs.shape[1]
         if (self.columns is None) or (len(self.columns) != nb_features):
             self.columns = ["Feature {}".format(j) for j in range(nb_features)]
         self.columns = np.array(self.columns)
 
-        features_scores = np.array([np.abs(col).mean() for col in sub_diffs_df.values.T])
+        features_scores = np.abs(sub_diffs).mean(axis=0)
         features_scores = 100 * features_scores / features_scores.sum()
         k_features = min(k_features, nb_features)
-        selected_features_ids = np.argsort(features_scores)[-k_features:][::-1]
+        selected_features_ids = np.argpartition(-features_scores, k_features - 1)[:k_features] # top k_features, then sorted
+        selected_features_ids = selected_features_ids[np.argsort(-features_scores[selected_features_ids])]
         selected_features_names = self.columns[selected_features_ids]
         selected_features_scores = features_scores[selected_features_ids]
 
@@ -232,15 +338,15 @@ class GroupAnomaly:
             if i == 0: axs[i][0].set_title("Original data")
             axs[i][0].set_xlabel("Time")
             axs[i][0].set_ylabel("{0}\n(Score: {1:.1f})".format(name, score))
-            for df_ori in sub_dfs_ori: axs[i][0].plot(df_ori.index, df_ori.values[:, j], color="silver")
-            axs[i][0].plot(sub_dfs_ori[uid].index, sub_dfs_ori[uid].values[:, j], color="red")
+            for times, vals in sub_ori: axs[i][0].plot(times, vals[:, j], color="silver")
+            axs[i][0].plot(sub_ori[uid][0], sub_ori[uid][1][:, j], color="red")
 
             if i == 0: axs[i][1].set_title("Transformed data")
             axs[i][1].set_xlabel("Time")
             axs[i][1].set_ylabel("{}".format(name))
-            for df in sub_dfs: axs[i][1].plot(df.index, df.values[:, j], color="silver")
-            axs[i][1].plot(sub_representatives_df.index, sub_representatives_df.values[:, j], color="black", linestyle='--')
-            axs[i][1].plot(sub_dfs[uid].index, sub_dfs[uid].values[:, j], color="red")
+            for times, vals in sub: axs[i][1].plot(times, vals[:, j], color="silver")
+            axs[i][1].plot(sub_times, sub_representatives[:, j], color="black", linestyle='--')
+            axs[i][1].plot(sub[uid][0], sub[uid][1][:, j], color="red")
 
         figg = None
         if k_features > 1:
@@ -251,15 +357,15 @@ class GroupAnomaly:
             ax1.set_title("Original data")
             ax1.set_xlabel("{0}\n(Score: {1:.1f})".format(nm1, s1))
             ax1.set_ylabel("{0}\n(Score: {1:.1f})".format(nm2, s2))
-            for df_ori in sub_dfs_ori: ax1.scatter(df_ori.values[:, j1], df_ori.values[:, j2], color="silver", marker=".")
-            ax1.scatter(sub_dfs_ori[uid].values[:, j1], sub_dfs_ori[uid].values[:, j2], color="red", marker=".", label="Unit {}".format(uid))
+            for _, vals in sub_ori: ax1.scatter(vals[:, j1], vals[:, j2], color="silver", marker=".")
+            ax1.scatter(sub_ori[uid][1][:, j1], sub_ori[uid][1][:, j2], color="red", marker=".", label="Unit {}".format(uid))
             ax1.legend()
 
             ax2.set_title("Transformed data")
             ax2.set_xlabel("{0}\n(Score: {1:.1f})".format(nm1, s1))
             ax2.set_ylabel("{0}\n(Score: {1:.1f})".format(nm2, s2))
-            for df in sub_dfs: ax2.scatter(df.values[:, j1], df.values[:, j2], color="silver", marker=".")
-            ax2.scatter(sub_dfs[uid].values[:, j1], sub_dfs[uid].values[:, j2], color="red", marker=".", label="Unit {}".format(uid))
+            for _, vals in sub: ax2.scatter(vals[:, j1], vals[:, j2], color="silver", marker=".")
+            ax2.scatter(sub[uid][1][:, j1], sub[uid][1][:, j2], color="red", marker=".", label="Unit {}".format(uid))
             ax2.legend()
 
         if savefig is None:
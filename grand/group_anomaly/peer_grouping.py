@@ -6,57 +6,277 @@ __author__ = "Mohamed-Rafik Bouguelia"
 __license__ = "MIT"
 __email__ = "mohamed-rafik.bouguelia@hh.se"
 
-from grand import utils
+from grand import utils, _kernels
+from ._online_stats import OnlineMedian
 import pandas as pd, numpy as np
+from scipy.spatial.distance import cdist
+
+class SlidingWindow:
+    '''Time-based sliding window over the samples of a single unit, stored in a (float32) ring buffer.
+    Samples are pushed in chronological order and the expired ones are evicted from the front,
+    so that updating the window costs amortized O(1) per sample.
+    
+    Parameters:
+    -----------
+    w : numpy.timedelta64
+        Width of the window. Samples older than (dt - w) are evicted at time dt.
+    
+    track_median : bool
+        If True, the median of the samples in the window is maintained incrementally in self.median (an OnlineMedian)
+    '''
+    
+    def __init__(self, w, track_median=False):
+        self.w = w
+        self.track_median = track_median
+        self.X, self.T = None, None
+        self.start, self.size = 0, 0
+        self.median = None
+    
+    # ===========================================
+    def push(self, dt, x):
+        '''Appends the sample x received at time dt (which should not be older than the previous samples)'''
+        
+        if self.X is None:
+            self.X = np.empty((64, len(x)), dtype=np.float32)
+            self.T = np.empty(64, dtype="datetime64[ns]")
+            if self.track_median: self.median = OnlineMedian(len(x))
+        elif self.size == len(self.T):
+            self.X = utils.grow_array(self.values(), self.size)
+            self.T = utils.grow_array(self.times(), self.size)
+            self.start = 0
+        
+        i = (self.start + self.size) % len(self.T)
+        self.X[i], self.T[i] = x, dt
+        self.size += 1
+        if self.track_median: self.median.push(self.X[i])
+    
+    # ===========================================
+    def evict(self, dt):
+        '''Removes the samples that are older than (dt - w), and returns them'''
+        
+        cutoff = dt - self.w
+        evicted = []
+        while self.size > 0 and self.T[self.start] < cutoff:
+            evicted.append(self.X[self.start])
+            if self.track_median: self.median.remove(self.X[self.start])
+            self.start = (self.start + 1) % len(self.T)
+            self.size -= 1
+        return evicted
+    
+    # ===========================================
+    def values(self, out=None):
+        '''Returns the samples currently in the window, shape (size, n_features), in chronological order.
+        If out is given, the samples are written into it (in place) and out is returned.
+        '''
+        
+        return self._ordered(self.X, out)
+    
+    def times(self, out=None):
+        '''Returns the times of the samples currently in the window, shape (size,)'''
+        
+        return self._ordered(self.T, out)
+    
+    def _ordered(self, arr, out=None):
+        end = self.start + self.size
+        if out is None:
+            if end <= len(arr): return arr[self.start: end]
+            return np.concatenate([arr[self.start:], arr[: end - len(arr)]])
+        
+        first = min(end, len(arr)) - self.start
+        out[:first] = arr[self.start: self.start + first]
+        out[first: self.size] = arr[: self.size - first]
+        return out
+    
+    # ===========================================
+    def last(self):
+        '''Returns the time and the value of the most recent sample in the window'''
+        
+        i = (self.start + self.size - 1) % len(self.T)
+        return self.T[i], self.X[i]
+
 
 class PeerGrouping:
     '''Construct reference groups
     
     Parameters:
     -----------
-    w_ref_group : string
+    w_ref_group : string or numpy.timedelta64
         Time window used to define the reference group, e.g. "7days", "12h" ...
         Possible values for the units can be found in https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.to_timedelta.html
+    
+    nb_units : int
+        Number of units
+    
+    track_median : bool
+        If True (and numba is available), the median of the reference groups is maintained incrementally
+        and returned by get_reference_median
     '''
     
-    def __init__(self, w_ref_group):
+    def __init__(self, w_ref_group, nb_units, track_median=False):
         self.w_ref_group = w_ref_group
+        self.w = pd.to_timedelta(w_ref_group).to_timedelta64()
+        self.nb_units = nb_units
+        self.track_median = track_median and _kernels.NUMBA_AVAILABLE
+        self.windows = [SlidingWindow(self.w, self.track_median) for _ in range(nb_units)]
+        self.group_median = None
+        self.group, self.distances = None, None
+        self.X_buf, self.owners_buf, self.D_buf = None, None, None
+        self.BLOCK_SIZE = 64
     
     # ===========================================
-    def get_target_and_reference(self, uid_test, dt, dffs):
+    def update(self, dt, x_units):
+        '''Slides the window of each unit to time dt
+        
+        Parameters:
+        -----------
+        dt : numpy.datetime64
+            Current datetime period
+        
+        x_units : array-like, shape (n_units, n_features)
+            Each element x_units[i] corresponds to a data-point (after features extraction) from the i'th unit at time dt.
+            Units which do not have data at time dt are given an empty element.
+        '''
+        
+        for window, x in zip(self.windows, x_units):
+            if len(x) > 0: window.push(dt, x)
+            evicted = window.evict(dt)
+            
+            if self.track_median:
+                if self.group_median is None and len(x) > 0: self.group_median = OnlineMedian(len(x))
+                if len(x) > 0: self.group_median.push(window.last()[1])
+                for xx in evicted: self.group_median.remove(xx)
+        self.group, self.distances = None, None
+    
+    # ===========================================
+    def get_group(self):
+        '''Returns the samples currently in the windows of all units
+        
+        Returns:
+        --------
+            X : array-like, shape (n_samples, n_features)
+                Samples of all units, ordered by unit then by time
+            
+            owners : array-like, shape (n_samples,)
+                owners[i] is the index of the unit from which X[i] comes
+        '''
+        
+        if self.group is None:
+            windows = [(uid, window) for uid, window in enumerate(self.windows) if window.size > 0]
+            n = sum(window.size for _, window in windows)
+            if n == 0:
+                self.group = np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int64)
+                return self.group
+            
+            # The samples are copied (in place) into a contiguous buffer, which is reused from one call to another
+            capacity = 0 if self.X_buf is None else len(self.X_buf)
+            if capacity < n:
+                self.X_buf = np.empty((max(n, 2 * capacity), windows[0][1].X.shape[1]), dtype=np.float32)
+                self.owners_buf = np.empty(len(self.X_buf), dtype=np.int64)
+            
+            i = 0
+            for uid, window in windows:
+                window.values(out=self.X_buf[i: i + window.size])
+                self.owners_buf[i: i + window.size] = uid
+                i += window.size
+            self.group = self.X_buf[:n], self.owners_buf[:n]
+        return self.group
+    
+    # ===========================================
+    def get_distances(self):
+        '''Returns the matrix of pairwise (euclidean) distances between the samples returned by self.get_group().
+        The matrix is computed by blocks of BLOCK_SIZE rows (so that each block of samples stays in cache),
+        into a buffer which is reused from one call to another.
+        Binary features (with values in {0, 1} only) are bit-packed, and their contribution to the squared distance
+        is computed as the number of differing bits (XOR + popcount) instead of the squared differences.
+        '''
+        
+        if self.distances is None:
+            X, _ = self.get_group()
+            n = len(X)
+            if n == 0:
+                self.distances = np.empty((0, 0))
+                return self.distances
+
+            capacity = 0 if self.D_buf is None else len(self.D_buf)
+            if capacity < n * n:
+                self.D_buf = np.empty(max(n * n, 2 * capacity))
+            D = self.D_buf[: n * n].reshape(n, n)
+            
+            bool_cols = ((X == 0) | (X == 1)).all(axis=0)
+            if not bool_cols.any():
+                for i in range(0, n, self.BLOCK_SIZE):
+                    cdist(X[i: i + self.BLOCK_SIZE], X, out=D[i: i + self.BLOCK_SIZE])
+            else:
+                Xf = X[:, ~bool_cols]
+                Xb = np.packbits(X[:, bool_cols].astype(bool), axis=1)
+                for i in range(0, n, self.BLOCK_SIZE):
+                    Di = D[i: i + self.BLOCK_SIZE]
+                    if Xf.shape[1] > 0: cdist(Xf[i: i + self.BLOCK_SIZE], Xf, "sqeuclidean", out=Di)
+                    else: Di[:] = 0
+                    Di += utils.popcount(Xb[i: i + self.BLOCK_SIZE, None, :] ^ Xb[None, :, :]).sum(axis=2)
+                    np.sqrt(Di, out=Di)
+            self.distances = D
+        return self.distances
+    
+    # ===========================================
+    def get_reference_median(self, uid_test):
+        '''Returns the median of the reference group of the unit uid_test (i.e. of the samples returned by
+        get_target_and_reference(uid_test, dt)[1]), or None if track_median is False.
+        '''
+        
+        if not self.track_median: return None
+        return self.group_median.median(exclude=self.windows[uid_test].median)
+    
+    # ===========================================
+    def get_target_id(self, uid_test, dt):
+        '''Returns the index of the test sample (from unit uid_test at time dt) in X, where X is returned by self.get_group()'''
+        
+        utils.validate_reference_grouping_input(uid_test, dt, self.windows)
+        
+        _, owners = self.get_group()
+        utils.validate_reference_group(owners[self.windows[uid_test].size:]) # as many samples as in the reference group
+        return np.searchsorted(owners, uid_test, side="right") - 1 # the last sample of the test unit
+    
+    def get_target_and_reference_ids(self, uid_test, dt):
+        '''Same as get_target_and_reference, but returns indexes of samples in X, where X is returned by self.get_group()
+        
+        Returns:
+        --------
+            id_test : int
+                Index of the test sample in X
+            
+            ids_ref : array-like, shape (n_samples,)
+                Indexes of the samples of the reference group in X
+        '''
+        
+        id_test = self.get_target_id(uid_test, dt)
+        _, owners = self.get_group()
+        return id_test, np.flatnonzero(owners != uid_test)
+    
+    # ===========================================
+    def get_target_and_reference(self, uid_test, dt):
         '''Extracts a test sample and its reference group
         
         Parameters:
         -----------
         uid_test : int
-            Index (in dffs) of the test unit. Must be in range(len(dffs)).
+            Index of the test unit. Must be in range(nb_units).
         
-        dt : datetime
-            Current datetime period
-            
-        dffs : list
-            Each element in dffs corresponds to one unit. The length of dffs should be the number of units.
-            Each element in dffs is a DataFrame containing the previous data (after features extraction) of the corresponding unit.
+        dt : numpy.datetime64
+            Current datetime period (the time of the last call to self.update)
         
         Returns:
         --------
             x : array-like, shape (n_features,)
-                Test sample extracted from the test unit (dffs[uid_test]) at time dt
+                Test sample extracted from the test unit at time dt
             
             Xref : array-like, shape (n_samples, n_features)
                 Latest samples in the reference group (other units) over a period of w_ref_group
         '''
         
-        utils.validate_reference_grouping_input(uid_test, dt, dffs)
-        
-        x = dffs[uid_test].loc[dt].values
-        Xref = []
-        for i, dff in enumerate(dffs):
-            if i == uid_test: continue
-            Xref += list( dff[dt - pd.to_timedelta(self.w_ref_group) : dt].values )
-        
-        utils.validate_reference_group(Xref)
-        Xref = np.array(Xref)
+        id_test, ids_ref = self.get_target_and_reference_ids(uid_test, dt)
+        X, _ = self.get_group()
+        x, Xref = X[id_test].copy(), X[ids_ref]
         return x, Xref
     
     # ===========================================
\ No newline at end of file
@@ -87,3 +87,143 @@ class Transformer:
                 z += [1. - pvalues[-1]] if len(pvalues) >= 1 else [0.5]
 
         return z
+
+
+class TransformerBatch:
+    '''Applies the same transformation as Transformer to the data of a group of units at once.
+    The state of all units is held in shared arrays, so that each call to transform_batch is a few vectorized
+    operations instead of one call per unit: the last w samples (or p-values) of each unit are kept in a circular
+    buffer of shape (nb_units, w, n_features), where the i'th sample of a unit is stored at position i % w,
+    and the normalizations use the running mean and variance of each unit.
+
+    Parameters:
+    ----------
+    nb_units : int
+        Number of units. Must be equal to len(x_units), where x_units is a parameter of the method self.transform_batch
+
+    w : int
+        Window used by the "slope", "pvalue" and "mean_pvalue" transformations
+
+    transformer : string
+        One of "mean_normalize", "std_normalize", "mean_std_normalize", "slope", "pvalue", "mean_pvalue" or None
+    '''
+
+    TRANSFORMERS = ["mean_normalize", "std_normalize", "mean_std_normalize", "slope", "pvalue", "mean_pvalue"]
+
+    def __init__(self, nb_units, w=20, transformer="pvalue"):
+        if (transformer is not None) and (transformer not in self.TRANSFORMERS):
+            raise utils.InputValidationError("transformer should be one of {}".format(self.TRANSFORMERS))
+
+        self.nb_units = nb_units
+        self.w = w
+        self.transformer = transformer
+        self.X = None # whole history of each unit (only needed by "pvalue" and "mean_pvalue")
+        self.W = None # circular buffer of the last w samples ("slope") or p-values ("pvalue" and "mean_pvalue")
+        self.mean = None # running mean of each unit ("*_normalize")
+        self.M2 = None # running sum of squared deviations from the mean of each unit ("*_normalize")
+        self.n = np.zeros(nb_units, dtype=int)
+        self.MIN_HISTORY_SIZE = 10
+
+    def transform_batch(self, x_units):
+        '''Transforms the data-point x_units[i] of each unit i based on the previous data of that unit.
+        Units which do not have data (empty x_units[i]) are left unchanged.
+        '''
+
+        ids = [i for i, x in enumerate(x_units) if len(x) > 0]
+        if len(ids) == 0 or self.transformer is None:
+            return x_units
+
+        ids = np.array(ids)
+        X = np.array([x_units[i] for i in ids], dtype=float)
+        self._reserve(X.shape[1])
+
+        if self.transformer in ["mean_normalize", "std_normalize", "mean_std_normalize"]:
+            with_mean = (self.transformer != "std_normalize")
+            with_std = (self.transformer != "mean_normalize")
+            Z = self._transform_normalize(ids, X, with_mean, with_std)
+
+        elif self.transformer in ["pvalue", "mean_pvalue"]:
+            aggregate = (self.transformer == "mean_pvalue")
+            Z = self._transform_pvalue(ids, X, aggregate)
+
+        else:
+            Z = self._transform_slope(ids, X)
+
+        x_units_tr = list(x_units)
+        for i, z in zip(ids, Z): x_units_tr[i] = z
+        return x_units_tr
+
+    def _reserve(self, nb_features):
+        if self.W is None:
+            self.W = np.zeros((self.nb_units, self.w, nb_features))
+            self.mean = np.zeros((self.nb_units, nb_features))
+            self.M2 = np.zeros((self.nb_units, nb_features))
+            if self.transformer in ["pvalue", "mean_pvalue"]:
+                self.X = np.zeros((self.nb_units, 64, nb_features))
+        elif self.X is not None and self.n.max() == self.X.shape[1]:
+            self.X = np.concatenate([self.X, np.zeros_like(self.X)], axis=1)
+
+    def _push_window(self, ids, X):
+        self.W[ids, self.n[ids] % self.w] = X
+
+    def _history_mask(self, n):
+        # mask[j, t] is True if t < n[j] (i.e. the t'th row of the history of the j'th unit is filled)
+        return np.arange(n.max())[None, :] < n[:, None]
+
+    def _last_rows(self, ids, n):
+        # Returns the last min(w, n[j]) rows of each unit's circular buffer, in chronological order
+        # (padded with zeros), and the corresponding mask
+        t = n[:, None] - self.w + np.arange(self.w)[None, :]
+        mask = t >= 0
+        return self.W[ids[:, None], t % self.w] * mask[:, :, None], mask
+
+    def _transform_slope(self, ids, X):
+        self._push_window(ids, X)
+        self.n[ids] += 1
+        n = self.n[ids]
+
+        Z = np.zeros(X.shape)
+        full = n >= self.w
+        if full.any():
+            Y, _ = self._last_rows(ids[full], n[full])
+            t = np.arange(self.w) - (self.w - 1) / 2
+            Z[full] = np.einsum("t,jtf->jf", t, Y) / np.dot(t, t)
+        return Z
+
+    def _transform_normalize(self, ids, X, with_mean=True, with_std=True):
+        # Welford's update of the running mean and variance
+        self.n[ids] += 1
+        n = self.n[ids][:, None]
+        delta = X - self.mean[ids]
+        self.mean[ids] += delta / n
+        self.M2[ids] += delta * (X - self.mean[ids])
+
+        Z = X.copy()
+        if with_mean:
+            Z -= self.mean[ids]
+
+        if with_std:
+            std = np.sqrt(self.M2[ids] / n)
+            Z /= np.where(std > 0, std, 1)
+
+        return Z
+
+    def _transform_pvalue(self, ids, X, aggregate=True):
+        n = self.n[ids]
+
+        p_arr = np.full(X.shape, 0.5)
+        enough = n >= self.MIN_HISTORY_SIZE
+        if enough.any():
+            H = self.X[ids[enough], :n[enough].max()]
+            mask = self._history_mask(n[enough])[:, :, None]
+            p_arr[enough] = ((H > X[enough][:, None]) & mask).sum(axis=1) / n[enough][:, None]
+
+        self._push_window(ids, p_arr)
+        self.X[ids, n] = X
+        self.n[ids] += 1
+
+        if aggregate:
+            pvalues, mask = self._last_rows(ids, n + 1)
+            return 1. - pvalues.sum(axis=1) / mask.sum(axis=1)[:, None]
+        else:
+            return 1. - p_arr
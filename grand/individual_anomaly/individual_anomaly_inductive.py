@@ -8,7 +8,7 @@ __license__ = "MIT"
 __email__ = "mohamed-rafik.bouguelia@hh.se"
 
 from grand.conformal import get_strangeness
-from grand.utils import DeviationContext, append_to_df
+from grand.utils import DeviationContext
 from grand import utils
 import matplotlib.pylab as plt, pandas as pd, numpy as np
 from pandas.plotting import register_matplotlib_converters
@@ -31,9 +31,13 @@ class IndividualAnomalyInductive:
         
     dev_threshold : float
         Threshold in [0,1] on the deviation level
+        
+    keep_history : bool
+        If True, the test samples and their strangeness, p-values and deviation levels are kept for plotting and analysis.
+        If False, only the state needed to compute the deviation level is kept (recommended for deployment).
     '''
     
-    def __init__(self, w_martingale=15, non_conformity="median", k=20, dev_threshold=0.6, columns=None):
+    def __init__(self, w_martingale=15, non_conformity="median", k=20, dev_threshold=0.6, columns=None, keep_history=True):
         utils.validate_individual_deviation_params(w_martingale, non_conformity, k, dev_threshold)
         
         self.w_martingale = w_martingale
@@ -41,34 +45,46 @@ class IndividualAnomalyInductive:
         self.k = k
         self.dev_threshold = dev_threshold
         self.columns = columns
+        self.keep_history = keep_history
         
         self.strg = get_strangeness(non_conformity, k)
-        self.T, self.S, self.P, self.M = [], [], [], []
+        # The strangeness, p-value and deviation level of each test sample (columns of self._stats, in float32)
+        # and its time are stored in preallocated arrays, exposed as the properties S, P, M and T
+        self._stats, self._T, self._n_stats = np.empty((64, 3), dtype=np.float32), np.empty(64, dtype="datetime64[ns]"), 0
         self.representatives, self.diffs = [], []
         
         self.mart = 0
         self.marts = [0, 0, 0]
 
-        self.df = pd.DataFrame(data=[], index=[])
+        # The test samples are stored in preallocated arrays, the DataFrame self.df is only built when needed (for plotting)
+        self._values, self._times, self._n = None, None, 0
+        self._df = None
 
     # ===========================================
-    def fit(self, X):
+    def fit(self, X, D=None, med=None):
         '''Fit the anomaly detector to the data X (assumed to be normal)
         Parameters:
         -----------
         X : array-like, shape (n_samples, n_features)
             Samples assumed to be not deviating from normal
         
+        D : array-like, shape (n_samples, n_samples), optional
+            Pairwise distances between the samples in X (used when non_conformity is "knn" or "lof").
+            Computed from X if not given.
+        
+        med : array-like, shape (n_features,), optional
+            Median of the samples in X (used when non_conformity is "median" or "lof"). Computed from X if not given.
+        
         Returns:
         --------
         self : object
         '''
         
-        self.strg.fit(X)
+        self.strg.fit(X, D, med)
         return self
     
     # ===========================================
-    def predict(self, dtime, x):
+    def predict(self, dtime, x, dists=None):
         '''Update the deviation level based on the new test sample x
         
         Parameters:
@@ -79,6 +95,10 @@ class IndividualAnomalyInductive:
         x : array-like, shape (n_features,)
             Sample for which the strangeness, p-value and deviation level are computed
         
+        dists : array-like, shape (n_samples,), optional
+            Distances between x and the samples given to fit (used when non_conformity is "knn" or "lof").
+            Computed from x if not given.
+        
         Returns:
         --------
         strangeness : float
@@ -91,23 +111,82 @@ class IndividualAnomalyInductive:
             Normalized deviation level updated based on the last w_martingale steps
         '''
         
-        self.T.append(dtime)
-        self.df = append_to_df(self.df, dtime, x)
-
-        strangeness, diff, representative = self.strg.predict(x)
-        self.S.append(strangeness)
-        self.diffs.append(diff)
-        self.representatives.append(representative)
-
+        strangeness, diff, representative = self.strg.predict(x, dists)
         pval = self.strg.pvalue(strangeness)
-        self.P.append(pval)
+        return self.update(dtime, x, strangeness, pval, representative)
+
+    # ===========================================
+    def update(self, dtime, x, strangeness, pval, representative):
+        '''Update the deviation level based on the new test sample x, whose strangeness and p-value were
+        already computed (e.g. by GroupAnomaly, for all the target units at once)
+        
+        Parameters:
+        -----------
+        dtime : datetime
+            datetime corresponding to the sample x
+        
+        x : array-like, shape (n_features,)
+            The test sample
+        
+        strangeness : float
+            Strangeness of x with respect to the reference samples
+        
+        pval : float, in [0, 1]
+            p-value of x with respect to the reference samples
+        
+        representative : array-like, shape (n_features,)
+            Representative of the reference samples to which x is compared (the median or the mean of the nearest neighbours)
+        
+        Returns:
+        --------
+        DeviationContext, as returned by predict
+        '''
         
         deviation = self._update_martingale(pval)
-        self.M.append(deviation)
+        
+        if self.keep_history:
+            self._stats, self._T, self._n_stats = utils.fast_append(self._stats, self._T, self._n_stats, dtime, (strangeness, pval, deviation), np.float32)
+            if len(x) > 0:
+                self._values, self._times, self._n = utils.fast_append(self._values, self._times, self._n, dtime, x)
+                self._df = None
+
+            self.diffs.append(x - representative)
+            self.representatives.append(representative)
         
         is_deviating = deviation > self.dev_threshold
         return DeviationContext(strangeness, pval, deviation, is_deviating)
         
+    # ===========================================
+    @property
+    def T(self):
+        '''Times of the test samples, as an array of datetime64'''
+        return self._T[:self._n_stats]
+
+    @property
+    def S(self):
+        '''Strangeness of the test samples'''
+        return self._stats[:self._n_stats, 0]
+
+    @property
+    def P(self):
+        '''p-values of the test samples'''
+        return self._stats[:self._n_stats, 1]
+
+    @property
+    def M(self):
+        '''Deviation levels after each test sample'''
+        return self._stats[:self._n_stats, 2]
+
+    @property
+    def df(self):
+        '''DataFrame of the test samples given to predict (or update), indexed by their datetime'''
+        
+        utils.validate_history_kept(self.keep_history)
+        if self._df is None:
+            if self._n == 0: self._df = pd.DataFrame(data=[], index=[])
+            else: self._df = pd.DataFrame(data=self._values[:self._n], index=pd.DatetimeIndex(self._times[:self._n]))
+        return self._df
+        
     # ===========================================
     def _update_martingale(self, pval):
         '''Incremental additive martingale over the last w_martingale steps.
@@ -127,6 +206,7 @@ class IndividualAnomalyInductive:
         
         self.mart += betting(pval)
         self.marts.append(self.mart)
+        if not self.keep_history: del self.marts[:-self.w_martingale] # only the last w_martingale values are used
         
         w = min(self.w_martingale, len(self.marts))
         mat_in_window = self.mart - self.marts[-w]
@@ -137,11 +217,13 @@ class IndividualAnomalyInductive:
         
     # ===========================================
     def get_stats(self):
+        utils.validate_history_kept(self.keep_history)
         stats = np.array([self.S, self.M, self.P]).T
         return pd.DataFrame(index=self.T, data=stats, columns=["strangeness", "deviation", "pvalue"])
 
     # ===========================================
     def get_all_deviations(self, min_len=5, dev_threshold=None):
+        utils.validate_history_kept(self.keep_history)
         if dev_threshold is None: dev_threshold = self.dev_threshold
 
         arr = np.arange(len(self.M))
@@ -161,8 +243,9 @@ class IndividualAnomalyInductive:
 
     # ===========================================
     def get_deviation_signature(self, from_time, to_time):
-        sub_diffs_df = pd.DataFrame(index=self.T, data=self.diffs)[from_time: to_time]
-        deviation_signature = np.mean(sub_diffs_df.values, axis=0)
+        utils.validate_history_kept(self.keep_history)
+        _, i0, i1 = utils.time_range(self.T, from_time, to_time)
+        deviation_signature = np.mean(np.asarray(self.diffs)[i0:i1], axis=0)
         return deviation_signature
 
     # ===========================================
@@ -177,14 +260,16 @@ class IndividualAnomalyInductive:
     def plot_deviations(self, figsize=None, savefig=None, plots=["data", "strangeness", "pvalue", "deviation", "threshold"], debug=False):
         '''Plots the anomaly score, deviation level and p-value, over time.'''
 
+        utils.validate_history_kept(self.keep_history)
         register_matplotlib_converters()
 
-        plots, nb_axs, i = list(set(plots)), 0, 0
+        plots, nb_axs, i = frozenset(plots), 0, 0
+        has_deviation_panel = bool(plots & {"pvalue", "deviation", "threshold"})
         if "data" in plots:
             nb_axs += 1
         if "strangeness" in plots:
             nb_axs += 1
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             nb_axs += 1
 
         fig, axes = plt.subplots(nb_axs, sharex="row", figsize=figsize)
@@ -209,7 +294,7 @@ class IndividualAnomalyInductive:
             axes[i].legend()
             i += 1
 
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             axes[i].set_xlabel("Time")
             axes[i].set_ylabel("Deviation")
             axes[i].set_ylim(0, 1)
@@ -233,6 +318,7 @@ class IndividualAnomalyInductive:
     # ===========================================
     def plot_explanations(self, from_time, to_time, figsize=None, savefig=None, k_features=4):
         # TODO: validate if the period (from_time, to_time) has data before plotting
+        utils.validate_history_kept(self.keep_history)
 
         from_time_pad = from_time - (to_time - from_time)
         to_time_pad = to_time + (to_time - from_time)
@@ -241,18 +327,22 @@ class IndividualAnomalyInductive:
         sub_df_before = self.df[from_time_pad: from_time]
         sub_df_after = self.df[to_time: to_time_pad]
 
-        sub_representatives_df_pad = pd.DataFrame(index=self.T, data=self.representatives)[from_time_pad: to_time_pad]
-        sub_diffs_df = pd.DataFrame(index=self.T, data=self.diffs)[from_time: to_time]
+        T, i0_pad, i1_pad = utils.time_range(self.T, from_time_pad, to_time_pad)
+        _, i0, i1 = utils.time_range(T, from_time, to_time)
+        sub_times_pad = T[i0_pad:i1_pad]
+        sub_representatives_pad = np.asarray(self.representatives)[i0_pad:i1_pad]
+        sub_diffs = np.asarray(self.diffs)[i0:i1]
 
-        nb_features = sub_diffs_df.values.shape[1]
+        nb_features = sub_diffs.shape[1]
         if (self.columns is None) or (len(self.columns) != nb_features):
             self.columns = ["Feature {}".format(j) for j in range(nb_features)]
         self.columns = np.array(self.columns)
 
-        features_scores = np.array([np.abs(col).mean() for col in sub_diffs_df.values.T])
+        features_scores = np.abs(sub_diffs).mean(axis=0)
         features_scores = 100 * features_scores / features_scores.sum()
         k_features = min(k_features, nb_features)
-        selected_features_ids = np.argsort(features_scores)[-k_features:][::-1]
+        selected_features_ids = np.argpartition(-features_scores, k_features - 1)[:k_features] # top k_features, then sorted
+        selected_features_ids = selected_features_ids[np.argsort(-features_scores[selected_features_ids])]
         selected_features_names = self.columns[selected_features_ids]
         selected_features_scores = features_scores[selected_features_ids]
 
@@ -266,7 +356,7 @@ class IndividualAnomalyInductive:
             print("{0}, score: {1:.2f}%".format(name, score))
             axs[i].set_xlabel("Time")
             axs[i].set_ylabel("{0}\n(Score: {1:.1f})".format(name, score))
-            axs[i].plot(sub_representatives_df_pad.index, sub_representatives_df_pad.values[:, j], color="grey", linestyle='--')
+            axs[i].plot(sub_times_pad, sub_representatives_pad[:, j], color="grey", linestyle='--')
             axs[i].plot(sub_df_before.index, sub_df_before.values[:, j], color="green")
             axs[i].plot(sub_df_after.index, sub_df_after.values[:, j], color="lime")
             axs[i].plot(sub_df.index, sub_df.values[:, j], color="red")
@@ -212,8 +212,8 @@ class IndividualAnomalyTransductive:
 
     # ===========================================
     def get_deviation_signature(self, from_time, to_time):
-        sub_diffs_df = pd.DataFrame(index=self.T, data=self.diffs)[from_time: to_time]
-        deviation_signature = np.mean(sub_diffs_df.values, axis=0)
+        _, i0, i1 = utils.time_range(self.T, from_time, to_time)
+        deviation_signature = np.mean(np.asarray(self.diffs)[i0:i1], axis=0)
         return deviation_signature
 
     # ===========================================
@@ -230,12 +230,13 @@ class IndividualAnomalyTransductive:
 
         register_matplotlib_converters()
 
-        plots, nb_axs, i = list(set(plots)), 0, 0
+        plots, nb_axs, i = frozenset(plots), 0, 0
+        has_deviation_panel = bool(plots & {"pvalue", "deviation", "threshold"})
         if "data" in plots:
             nb_axs += 1
         if "strangeness" in plots:
             nb_axs += 1
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             nb_axs += 1
 
         fig, axes = plt.subplots(nb_axs, sharex="row", figsize=figsize)
@@ -260,7 +261,7 @@ class IndividualAnomalyTransductive:
             axes[i].legend()
             i += 1
 
-        if any(s in ["pvalue", "deviation", "threshold"] for s in plots):
+        if has_deviation_panel:
             axes[i].set_xlabel("Time")
             axes[i].set_ylabel("Deviation")
             axes[i].set_ylim(0, 1)
@@ -292,18 +293,22 @@ class IndividualAnomalyTransductive:
         sub_df_before = self.df[from_time_pad: from_time]
         sub_df_after = self.df[to_time: to_time_pad]
 
-        sub_representatives_df_pad = pd.DataFrame(index=self.T, data=self.representatives)[from_time_pad: to_time_pad]
-        sub_diffs_df = pd.DataFrame(index=self.T, data=self.diffs)[from_time: to_time]
+        T, i0_pad, i1_pad = utils.time_range(self.T, from_time_pad, to_time_pad)
+        _, i0, i1 = utils.time_range(T, from_time, to_time)
+        sub_times_pad = T[i0_pad:i1_pad]
+        sub_representatives_pad = np.asarray(self.representatives)[i0_pad:i1_pad]
+        sub_diffs = np.asarray(self.diffs)[i0:i1]
 
-        nb_features = sub_diffs_df.values.shape[1]
+        nb_features = sub_diffs.shape[1]
         if (self.columns is None) or (len(self.columns) != nb_features):
             self.columns = ["Feature {}".format(j) for j in range(nb_features)]
         self.columns = np.array(self.columns)
 
-        features_scores = np.array([np.abs(col).mean() for col in sub_diffs_df.values.T])
+        features_scores = np.abs(sub_diffs).mean(axis=0)
         features_scores = 100 * features_scores / features_scores.sum()
         k_features = min(k_features, nb_features)
-        selected_features_ids = np.argsort(features_scores)[-k_features:][::-1]
+        selected_features_ids = np.argpartition(-features_scores, k_features - 1)[:k_features] # top k_features, then sorted
+        selected_features_ids = selected_features_ids[np.argsort(-features_scores[selected_features_ids])]
         selected_features_names = self.columns[selected_features_ids]
         selected_features_scores = features_scores[selected_features_ids]
 
@@ -316,7 +321,7 @@ class IndividualAnomalyTransductive:
         for i, (j, name, score) in enumerate(zip(selected_features_ids, selected_features_names, selected_features_scores)):
             axs[i].set_xlabel("Time")
             axs[i].set_ylabel("{0}\n(Score: {1:.1f})".format(name, score))
-            axs[i].plot(sub_representatives_df_pad.index, sub_representatives_df_pad.values[:, j], color="grey", linestyle='--')
+            axs[i].plot(sub_times_pad, sub_representatives_pad[:, j], color="grey", linestyle='--')
             axs[i].plot(sub_df_before.index, sub_df_before.values[:, j], color="green")
             axs[i].plot(sub_df_after.index, sub_df_after.values[:, j], color="lime")
             axs[i].plot(sub_df.index, sub_df.values[:, j], color="red")
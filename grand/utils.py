@@ -17,6 +17,7 @@ class NotFittedError(Exception): pass
 class InputValidationError(Exception): pass
 class TestUnitError(Exception): pass
 class NoRefGroupError(Exception): pass
+class NoHistoryError(Exception): pass
 
 
 # ===========================================
@@ -29,6 +30,38 @@ def append_to_df(df, dt, x): # Appends a new row to a DataFrame
         return df
 
 
+# ===========================================
+def grow_array(arr, n): # Returns a copy of arr with its first n rows and twice its capacity
+    new_arr = np.empty((2 * len(arr),) + arr.shape[1:], dtype=arr.dtype)
+    new_arr[:n] = arr[:n]
+    return new_arr
+
+
+# ===========================================
+def fast_append(values_arr, times_arr, n, dt, x, dtype=float): # Writes (dt, x) at row n of preallocated arrays (allocated or grown by doubling if needed), returns the arrays and n+1
+    if values_arr is None: values_arr = np.empty((64, len(x)), dtype=dtype)
+    elif n == len(values_arr): values_arr = grow_array(values_arr, n)
+    if times_arr is None: times_arr = np.empty(64, dtype="datetime64[ns]")
+    elif n == len(times_arr): times_arr = grow_array(times_arr, n)
+    values_arr[n], times_arr[n] = x, dt
+    return values_arr, times_arr, n + 1
+
+
+# ===========================================
+def time_range(T, from_time, to_time): # Sorted times T as an array, and the indexes i0, i1 such that T[i0:i1] are in [from_time, to_time], as with df[from_time: to_time] (e.g. a date string includes the whole day)
+    T = np.asarray(T, dtype="datetime64[ns]")
+    s = pd.DatetimeIndex(T).slice_indexer(from_time, to_time)
+    return T, s.start, s.stop
+
+
+# ===========================================
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount(arr): # Number of bits set in each element of a uint8 array
+    if hasattr(np, "bitwise_count"): return np.bitwise_count(arr)
+    return POPCOUNT_TABLE[arr]
+
+
 # ===========================================
 def create_directory_from_path(pathname):
     pathname = pl.Path(pathname).resolve()
@@ -85,21 +118,24 @@ def validate_is_fitted(is_fitted):
         raise NotFittedError("'fit' must be called before calling 'get'")
 
 
+def validate_history_kept(keep_history):
+    if not keep_history:
+        raise NoHistoryError("The history is not kept (keep_history=False), it can not be plotted or analysed")
+
+
 def validate_reference_group(Xref):
     if len(Xref) == 0:
         raise NoRefGroupError("Empty reference group data.")
 
 
-def validate_reference_grouping_input(uid_test, dt, dffs):
-    if not (0 <= uid_test < len(dffs)):
-        raise InputValidationError("uid_test should be in range(nb_units). Given uid_test = {}, nb_units is {}".format(uid_test, len(dffs)))
+def validate_reference_grouping_input(uid_test, dt, windows):
+    if not (0 <= uid_test < len(windows)):
+        raise InputValidationError("uid_test should be in range(nb_units). Given uid_test = {}, nb_units is {}".format(uid_test, len(windows)))
         
-    if len(dffs[uid_test]) == 0:
+    if windows[uid_test].size == 0:
         raise TestUnitError("Test unit (uid={}) does not have data".format(uid_test))
     
-    try:
-        x = dffs[uid_test].loc[dt].values
-    except KeyError:
+    if windows[uid_test].last()[0] != dt:
         raise TestUnitError("Test unit (uid={}) does not have data at time {}".format(uid_test, dt))
 
 
@@ -10,6 +10,14 @@ version_str = mo.group(1)
 data_path = '.{}grand{}datasets{}data'.format(os.sep, os.sep, os.sep)
 data_files = [ 'datasets' + os.sep + 'data' + os.sep + dirname + os.sep + '*' for dirname in os.listdir(data_path) ]
 
+# The batch kernels are compiled ahead of time into the extension module grand._kernels_aot when numba
+# is installed (see grand/_compile_kernels.py). Otherwise, they are compiled with numba at their first call (if installed).
+try:
+    from grand._compile_kernels import cc
+    ext_modules = [cc.distutils_extension()]
+except ImportError:
+    ext_modules = []
+
 setup(name='grand',
     version=version_str,
     description='GRAND: Group-based Anomaly Detection for Large-Scale Monitoring of Complex Systems',
@@ -19,6 +27,8 @@ setup(name='grand',
     license='MIT',
     packages=find_packages(),
     package_data={'grand':data_files},
+    ext_modules=ext_modules,
     install_requires=['matplotlib>=2.1.0', 'numpy>=1.13.3', 'pandas>=0.22.0', 'scipy>=1.0.0', 'scikit-learn>=0.20.0'],
+    extras_require={'numba': ['numba>=0.45.0']},
     zip_safe=False,
     python_requires='>=3.4')